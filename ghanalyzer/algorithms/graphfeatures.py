@@ -1,4 +1,5 @@
 from collections import defaultdict
+from itertools import izip
 
 import numpy as np
 import networkx as nx
@@ -21,6 +22,7 @@ __all__ = [
 
 class EdgeFeature(object):
     feature_count = 0
+    root_dependent = False
 
     def __init__(self, adj):
         assert isinstance(adj, AdjacencyMatrix)
@@ -33,27 +35,37 @@ class EdgeFeature(object):
         self.indices = adj.matrix.indices
         self.indptr = adj.matrix.indptr
         self.edge_count = adj.matrix.data.size
+        self.rows = adj.rows
 
-    def _find_node(self, nodes, node_cls):
-        for n in nodes:
-            if isinstance(n, node_cls):
-                return n
+    def _find_node_indices(self, node_cls):
+        """find the endpoint of each edge which is an instance of node_cls
+        (the source node is preferred when both endpoints are)
+        """
+        is_instance = np.array([isinstance(n, node_cls) for n in self.nodes], dtype=bool)
+        return np.where(is_instance[self.rows], self.rows, self.indices)
 
     def _iter_edges(self):
-        for r in xrange(len(self.nodes)):
-            for i in xrange(self.indptr[r], self.indptr[r+1]):
-                c = self.indices[i]
-                yield self.nodes[r], self.nodes[c]
+        for r, c in izip(self.rows, self.indices):
+            yield self.nodes[r], self.nodes[c]
+
+    def _standardize(self, features):
+        return StandardScaler().fit_transform(features).astype(np.float32, copy=False)
 
     def _create_feature_matrix(self, feature_getter, root=None, standardize=True):
-        features = np.zeros((self.edge_count, self.feature_count))
+        features = np.zeros((self.edge_count, self.feature_count), dtype=np.float32)
         for i, (u, v) in enumerate(self._iter_edges()):
-            feature = feature_getter(u, v, root)
-            if feature is None:
-                continue
-            features[i, :] = feature
+            features[i, :] = feature_getter(u, v, root)
+        if standardize:
+            features = self._standardize(features)
+        return features
+
+    def _expand_node_features(self, node_features, node_cls, standardize=True):
+        """treat the feature of the endpoint which is an instance of node_cls
+        as the feature of each edge (node_features is aligned to self.nodes)
+        """
+        features = node_features[self._find_node_indices(node_cls), :]
         if standardize:
-            features = StandardScaler().fit_transform(features)
+            features = self._standardize(features)
         return features
 
     def get_feature_matrix(self, root=None):
@@ -64,7 +76,7 @@ class DummyFeature(EdgeFeature):
     feature_count = 0
 
     def get_feature_matrix(self, root=None):
-        return np.zeros((self.edge_count, self.feature_count))
+        return np.zeros((self.edge_count, self.feature_count), dtype=np.float32)
 
 
 class ConstantFeature(EdgeFeature):
@@ -73,7 +85,7 @@ class ConstantFeature(EdgeFeature):
     def __init__(self, adj, value=1):
         super(ConstantFeature, self).__init__(adj)
         self.value = value
-        self.features = np.empty((self.edge_count, self.feature_count))
+        self.features = np.empty((self.edge_count, self.feature_count), dtype=np.float32)
         self.features.fill(self.value)
 
     def get_feature_matrix(self, root=None):
@@ -91,20 +103,21 @@ class NodeFeature(EdgeFeature):
             self.entities = self._load_entities(data_path)
         else:
             self.entities = defaultdict(dict)
-        self.features = self._create_feature_matrix(self._get_feature, standardize)
+        self.features = self._expand_node_features(self._get_node_features(),
+            self.node_cls, standardize)
 
     def _load_entities(self, path):
         raise NotImplementedError()
 
-    def _get_feature(self, u, v, root=None):
-        target = self._find_node((u, v), self.node_cls)
-        if target is None:
-            return
-        item = self.entities[target.id]
-        if target in self.graph:
-            item.update(self.graph.node[target])
-        feature = [float(item.get(k) or 0) for k in self.keys]
-        return feature
+    def _get_node_features(self):
+        node_features = np.zeros((len(self.nodes), self.feature_count), dtype=np.float32)
+        for i, n in enumerate(self.nodes):
+            if not isinstance(n, self.node_cls):
+                continue
+            item = self.entities[n.id]
+            item.update(self.graph.node[n])
+            node_features[i, :] = [float(item.get(k) or 0) for k in self.keys]
+        return node_features
 
     def get_feature_matrix(self, root=None):
         return self.features
@@ -132,18 +145,27 @@ class LanguageFeature(EdgeFeature):
         super(LanguageFeature, self).__init__(adj)
         self.languages = load_repository_languages(data_path)
         self.languages = LanguageVector(self.languages)
-        self.language_features = self.languages.features.toarray()
-        self.feature_count = self.features.shape[1]
-        self.features = self._create_feature_matrix(self._get_feature, standardize)
-
-    def _get_feature(self, u, v, root=None):
-        repo = self._find_node((u, v), Repository)
-        if repo is None:
-            return
-        index = self.languages.sample_indices.get(repo.id, None)
-        if index is None:
-            return
-        return list(self.language_features[index, :])
+        self.feature_count = self.languages.features.shape[1]
+        self.features = self._create_language_feature_matrix(standardize)
+
+    def _get_language_indices(self):
+        """find the row of each node in the language feature matrix (-1 if absent)"""
+        indices = np.empty((len(self.nodes),), dtype=np.int64)
+        indices.fill(-1)
+        for i, n in enumerate(self.nodes):
+            if isinstance(n, Repository):
+                indices[i] = self.languages.sample_indices.get(n.id, -1)
+        return indices
+
+    def _create_language_feature_matrix(self, standardize=True):
+        # gather sparse rows for the edges only, without densifying the whole matrix
+        rows = self._get_language_indices()[self._find_node_indices(Repository)]
+        valid = rows >= 0
+        features = np.zeros((self.edge_count, self.feature_count), dtype=np.float32)
+        features[valid, :] = self.languages.features[rows[valid], :].toarray()
+        if standardize:
+            features = self._standardize(features)
+        return features
 
     def get_feature_matrix(self, root=None):
         return self.features
@@ -170,20 +192,48 @@ class CombinedFeature(EdgeFeature):
             extractors = (DummyFeature(adj),)
         self.extractors = extractors
         self.feature_count = sum(e.feature_count for e in self.extractors)
+        self.root_dependent = any(e.root_dependent for e in self.extractors)
+        self.offsets = np.cumsum([0] + [e.feature_count for e in self.extractors])
+        if len(self.extractors) > 1:
+            # fill the features which do not depend on the root node only once
+            self.features = np.empty((self.edge_count, self.feature_count), dtype=np.float32)
+            for e, start, end in self._iter_slices(root_dependent=False):
+                self.features[:, start:end] = e.get_feature_matrix()
+
+    def _iter_slices(self, root_dependent):
+        for i, e in enumerate(self.extractors):
+            if e.root_dependent == root_dependent:
+                yield e, self.offsets[i], self.offsets[i+1]
 
     def get_feature_matrix(self, root=None):
-        features = tuple(e.get_feature_matrix(root) for e in self.extractors)
-        return np.concatenate(features, axis=1)
+        """get the combined feature matrix
+        (the returned buffer is overwritten by the next call)
+        """
+        if len(self.extractors) == 1:
+            return self.extractors[0].get_feature_matrix(root)
+        for e, start, end in self._iter_slices(root_dependent=True):
+            self.features[:, start:end] = e.get_feature_matrix(root)
+        return self.features
 
 
 class SimilarityFeature(EdgeFeature):
     feature_count = 2
+    root_dependent = True
 
     def __init__(self, adj, similarity, standardize=True):
         super(SimilarityFeature, self).__init__(adj)
         assert isinstance(similarity, BigraphSimilarity)
         self.similarity = similarity
         self.standardize = standardize
+        self.source_slots, self.source_nodes = self._map_nodes(self.similarity.bigraph.sources)
+        self.target_slots, self.target_nodes = self._map_nodes(self.similarity.bigraph.targets)
+
+    def _map_nodes(self, nodes):
+        """map positions in the bigraph node list to indices of the same nodes in the graph"""
+        indices = np.fromiter((self.node_indices.get(n, -1) for n in nodes),
+            dtype=np.int64, count=len(nodes))
+        slots = np.flatnonzero(indices >= 0)
+        return slots, indices[slots]
 
     def get_feature_matrix(self, root=None):
         root = self.nodes[root]
@@ -198,18 +248,12 @@ class SimilarityFeature(EdgeFeature):
         else:
             raise ValueError('unable to measure similarities between the root node and other nodes')
 
-        node_features = np.zeros((len(self.nodes), 2))
-        for s, node in enumerate(self.similarity.bigraph.sources):
-            index = self.node_indices.get(node, None)
-            if index is not None:
-                node_features[index, 0] = source_similarity[r, s]
-        for t, node in enumerate(self.similarity.bigraph.targets):
-            index = self.node_indices.get(node, None)
-            if index is not None:
-                node_features[index, 1] = target_similarity[r, t]
+        node_features = np.zeros((len(self.nodes), 2), dtype=np.float32)
+        node_features[self.source_nodes, 0] = source_similarity[r, self.source_slots]
+        node_features[self.target_nodes, 1] = target_similarity[r, self.target_slots]
 
         # treat the feature of node v as the feature of edge (u, v)
         features = node_features[self.indices, :]
         if self.standardize:
-            features = StandardScaler().fit_transform(features)
+            features = self._standardize(features)
         return features
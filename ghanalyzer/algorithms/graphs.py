@@ -1,5 +1,6 @@
+import numpy as np
 import networkx as nx
-from scipy.sparse import dok_matrix
+from scipy.sparse import dok_matrix, csr_matrix
 from sklearn.preprocessing import normalize
 from sklearn.metrics.pairwise import linear_kernel
 
@@ -55,8 +56,39 @@ class AdjacencyMatrix(object):
         self.graph = graph
         self.nodes = self.graph.nodes()
         self.node_indices = {n: i for i, n in enumerate(self.nodes)}
-        self.matrix = nx.to_scipy_sparse_matrix(self.graph, nodelist=self.nodes,
-            dtype=dtype, weight=weight, format=format)
+        if format == 'csr' and not self.graph.is_multigraph():
+            self.matrix = self._build_csr_matrix(weight=weight, dtype=dtype)
+        else:
+            self.matrix = nx.to_scipy_sparse_matrix(self.graph, nodelist=self.nodes,
+                dtype=dtype, weight=weight, format=format)
+            if format in ('csr', 'csc'):
+                self.matrix.sort_indices()
+
+    @property
+    def rows(self):
+        """row index of each stored entry of the csr_matrix (in CSR order)"""
+        if not hasattr(self, '_rows'):
+            n = self.matrix.shape[0]
+            self._rows = np.repeat(np.arange(n), np.diff(self.matrix.indptr))
+        return self._rows
+
+    def _build_csr_matrix(self, weight=None, dtype=None):
+        """build csr_matrix directly from the adjacency lists
+        (column indices are sorted within each row)
+        """
+        n = len(self.nodes)
+        indptr = np.zeros((n + 1,), dtype=np.int32)
+        indptr[1:] = np.cumsum([len(self.graph[u]) for u in self.nodes])
+        indices = np.empty((indptr[-1],), dtype=np.int32)
+        data = np.empty((indptr[-1],), dtype=dtype)
+        for i, u in enumerate(self.nodes):
+            row = sorted((self.node_indices[v], 1 if weight is None else d.get(weight, 1))
+                for v, d in self.graph[u].iteritems())
+            if row:
+                indices[indptr[i]:indptr[i+1]], data[indptr[i]:indptr[i+1]] = zip(*row)
+        matrix = csr_matrix((data, indices, indptr), shape=(n, n))
+        matrix.has_sorted_indices = True
+        return matrix
 
 
 class BigraphSimilarity(object):
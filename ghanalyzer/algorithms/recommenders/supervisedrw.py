@@ -5,8 +5,9 @@ from itertools import izip
 import numpy as np
 import networkx as nx
 from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import LinearOperator, gmres
 from scipy.optimize import fmin_l_bfgs_b
-from sklearn.preprocessing import normalize
+from scipy.special import expit
 
 from ghanalyzer.algorithms.features import (
     load_language_features,
@@ -17,13 +18,12 @@ from ghanalyzer.algorithms.graphs import Bigraph, AdjacencyMatrix, BigraphSimila
 from ghanalyzer.algorithms.graphfeatures import *
 from ghanalyzer.algorithms.recommenders.base import Recommender
 from ghanalyzer.models import User, Repository
-from ghanalyzer.utils.randomwalk import check_converged
 from ghanalyzer.utils.recommendation import recommend_by_rank
 from ghanalyzer.utils import sparsetools
 
 
 def sigmoid(x):
-    return 1 / (1 + np.exp(-x))
+    return expit(x)
 
 class SupervisedRWRecommender(Recommender):
     parameters = ['alpha', 'max_steps', 'lambda_', 'epsilon', 'loss_width',
@@ -50,14 +50,24 @@ class SupervisedRWRecommender(Recommender):
         self.node_indices = self.feature_extractor.node_indices
         self.indices = self.feature_extractor.indices
         self.indptr = self.feature_extractor.indptr
+        self.rows = self.feature_extractor.rows
         self.N = len(self.nodes)
         self.E = self.feature_extractor.edge_count
         self.M = self.feature_extractor.feature_count
+        self.candidate_set = frozenset(self.candidates)
+        self.candidate_indices = np.array([self.node_indices[c] for c in self.candidates],
+            dtype=np.int64)
+        self._dA = np.empty((self.E, self.M), dtype=np.float32, order='F')
+        self._P_rows = np.empty((self.E,))
+        self._PdQ = np.empty((self.E, self.M), order='F')
+        self._edge_strength_cache = None
+        self._w = None
 
     def recommend(self, user, n=None):
         rank = self._get_rank(user)
-        rank = {k: v for k, v in izip(self.nodes, rank) \
-            if isinstance(k, Repository) and k not in self.graph[user]}
+        neighbors = self.graph[user]
+        rank = {k: v for k, v in izip(self.candidates, rank[self.candidate_indices]) \
+            if k not in neighbors}
         return recommend_by_rank(rank, n)
 
     def _create_feature_extractor(self):
@@ -96,103 +106,105 @@ class SupervisedRWRecommender(Recommender):
         return CombinedFeature(self.adj, *extractors)
 
     def _csr_from_data(self, data):
-        return csr_matrix((data, self.indices, self.indptr), shape=(self.N, self.N))
+        matrix = csr_matrix((data, self.indices, self.indptr), shape=(self.N, self.N),
+            copy=False)
+        matrix.has_sorted_indices = True  # shares the pattern of the adjacency matrix
+        return matrix
 
     def _get_edge_feature(self, root):
         psi = self.feature_extractor.get_feature_matrix(root)
         return psi
 
     def _get_edge_strength(self, psi, w):
-        S = np.einsum('ij,j->i', psi, w)
-        A = sigmoid(S)
-        dA = np.empty((self.E, self.M), order='F')
+        # L-BFGS usually ends on the weights it evaluated last
+        cache = self._edge_strength_cache
+        if cache is not None and cache[0] is psi and np.array_equal(cache[1], w):
+            return cache[2], cache[3]
+        A = sigmoid(psi.dot(w.astype(np.float32)))
         derivative = A * (1 - A)
-        np.multiply(derivative[:, np.newaxis], psi, out=dA)
+        dA = np.multiply(derivative[:, np.newaxis], psi, out=self._dA)
+        self._edge_strength_cache = (psi, w.copy(), A, dA)
         return A, dA
 
     def _get_transition_probability(self, A):
         """calculate unbiased transition probability matrix Q0 such that
         Q = (1 - alpha) * Q0 + alpha * E_root
         where E_root is a matrix containing 1 in the root node's column and 0 elsewhere
+        (the row sums of A are returned as well)
         """
-        Q0 = self._csr_from_data(A)
-        Q0 = normalize(Q0, norm='l1')
-        return Q0
+        data, norm = sparsetools.csr_matrix_normalize_row(self.indptr, A)
+        return self._csr_from_data(data), norm
 
-    def _get_transition_probability_derivative(self, A, dA):
-        F = self._csr_from_data(A)
-        norm_F = sparsetools.sum_csr_matrix_column(F)
-        denominator = (1.0 - self.alpha) / np.power(norm_F, 2)
+    def _get_transition_probability_derivative(self, Q0, norm, dA):
+        """calculate the derivative of Q with respect to each feature weight,
+        as an (E, M) array of CSR data sharing the sparsity pattern of Q0
+        """
+        return sparsetools.csr_matrix_normalize_row_derivative(self.indptr, Q0.data, norm,
+            dA, 1.0 - self.alpha)
 
-        dQ = np.empty((self.M,), dtype=object)
-        for m in xrange(self.M):
-            dFm = self._csr_from_data(dA[:, m])
-            norm_dFm = sparsetools.sum_csr_matrix_column(dFm)
-            
-            X = sparsetools.csr_matrix_scale_row(dFm, norm_F).data
-            Y = sparsetools.csr_matrix_scale_row(F, norm_dFm).data
-            dQ[m] = self._csr_from_data(X - Y)
-            sparsetools.csr_matrix_scale_row(dQ[m], denominator, inplace=True)
-
-        return dQ
-
-    def _get_stationary_distribution(self, Q0, root):
-        P = np.zeros((self.N,))
-        P[root] = 1.0
-        converged, delta = False, 0.0
-        for _ in xrange(self.max_steps):
-            P1 = sparsetools.vector_csr_matrix_multiply(P, Q0)
-            P1 *= 1 - self.alpha
-            P1[root] += self.alpha
-            converged, delta = check_converged(P, P1, self.epsilon)
-            if converged:
-                break
-            P = P1
+    def _get_stationary_operator(self, Q0):
+        """build linear operator W = I - (1 - alpha) * Q0^T
+        so that the stationary distribution satisfies W * P = alpha * e_root
+        """
+        beta = 1 - self.alpha
+
+        def matvec(x):
+            x = np.ravel(x)
+            QTx = sparsetools.vector_csr_data_multiply(x, self.indptr, self.indices, Q0.data)
+            return x - beta * QTx
+
+        def rmatvec(x):
+            x = np.ravel(x)
+            return x - beta * Q0.dot(x)
+
+        return LinearOperator((self.N, self.N), matvec=matvec, rmatvec=rmatvec,
+            dtype=np.float64)
+
+    def _solve(self, operator, b):
+        x, info = gmres(operator, b, tol=self.epsilon, maxiter=self.max_steps)
+        return x, info == 0
+
+    def _get_stationary_distribution(self, operator, root):
+        b = np.zeros((self.N,))
+        b[root] = self.alpha
+        P, converged = self._solve(operator, b)
         if not converged:
             print 'Warning: stationary distribution does not converge ' \
-                'in %d iteration(s) (delta=%f)' % (self.max_steps, delta)
+                'in %d iteration(s)' % self.max_steps
         return P
 
-    def _get_stationary_distribution_derivative(self, P, Q0, dQ, root):
-        shape = (self.N, self.N)
+    def _get_stationary_distribution_derivative(self, P, operator, dQ):
         dP = np.zeros((self.N, self.M), order='F')
+        # P * dQ[m] scatters P[u] * dQ[(u, v), m] onto column v for each edge (u, v)
+        P_rows = np.take(P, self.rows, out=self._P_rows)
+        PdQ = np.multiply(dQ, P_rows[:, np.newaxis], out=self._PdQ)
         for m in xrange(self.M):
-            PdQ = sparsetools.vector_csr_matrix_multiply(P, dQ[m])
-            converged, delta = False, 0.0
-            for _ in xrange(self.max_steps):
-                dPQ = sparsetools.vector_csr_matrix_multiply(dP[:, m], Q0)
-                dPQ *= 1 - self.alpha
-                dPQ[root] += self.alpha * dP[:, m].sum()
-                dPm = dPQ + PdQ
-                converged, delta = check_converged(dP[:, m], dPm, self.epsilon)
-                if converged:
-                    break
-                dP[:, m] = dPm
+            b = np.bincount(self.indices, weights=PdQ[:, m], minlength=self.N)
+            dP[:, m], converged = self._solve(operator, b)
             if not converged:
                 print 'Warning: stationary distribution derivative does not converge ' \
-                    'in %d iteration(s) (delta=%f, m=%d)' % (self.max_steps, delta, m)
+                    'in %d iteration(s) (m=%d)' % (self.max_steps, m)
         return dP
 
-    def _loss_function(self, w, psi, root, pairs):
+    def _loss_function(self, w, psi, root, pairs_u, pairs_v):
         A, dA = self._get_edge_strength(psi, w)
-        Q0 = self._get_transition_probability(A)
-        dQ = self._get_transition_probability_derivative(A, dA)
-        P = self._get_stationary_distribution(Q0, root)
-        dP = self._get_stationary_distribution_derivative(P, Q0, dQ, root)
+        Q0, norm = self._get_transition_probability(A)
+        dQ = self._get_transition_probability_derivative(Q0, norm, dA)
+        operator = self._get_stationary_operator(Q0)
+        P = self._get_stationary_distribution(operator, root)
+        dP = self._get_stationary_distribution_derivative(P, operator, dQ)
 
-        diff = np.array([P[u] - P[v] for u, v in pairs])
+        diff = P[pairs_u] - P[pairs_v]
         loss = sigmoid(diff / self.loss_width)
         objective = np.sum(w ** 2) + self.lambda_ * np.sum(loss)
         ddiff = loss * (1 - loss) / self.loss_width
-        dpairs = np.empty((len(pairs), self.M))
-        for i, (u, v) in enumerate(pairs):
-            dpairs[i, :] = dP[u, :] - dP[v, :]
-        gradient = 2 * w + np.einsum('i,im->m', ddiff, dpairs) * self.lambda_
+        dpairs = dP[pairs_u, :] - dP[pairs_v, :]
+        gradient = 2 * w + ddiff.dot(dpairs) * self.lambda_
         return objective, gradient
 
     def _select_samples(self, user):
         positive = self.graph.neighbors(user)
-        others = set(self.candidates) - set(positive)
+        others = self.candidate_set.difference(positive)
         negative = random.sample(others, min(len(positive), len(others)))
         positive = [self.node_indices[x] for x in positive]
         negative = [self.node_indices[x] for x in negative]
@@ -200,13 +212,19 @@ class SupervisedRWRecommender(Recommender):
 
     def _get_rank(self, user):
         positive, negative = self._select_samples(user)
-        pairs = [(u, v) for u in negative for v in positive]
+        pairs_u = np.repeat(np.array(negative, dtype=np.int64), len(positive))
+        pairs_v = np.tile(np.array(positive, dtype=np.int64), len(negative))
         u = self.node_indices[user]
         psi = self._get_edge_feature(u)
-
-        w0 = np.random.rand(self.M)
-        w, _, _ = fmin_l_bfgs_b(self._loss_function, w0, args=(psi, u, pairs), iprint=0)
+        if self.feature_extractor.root_dependent:
+            self._edge_strength_cache = None  # psi may be a reused buffer
+
+        # warm start from the weights learned for the previous user
+        w0 = self._w if self._w is not None else np.random.rand(self.M)
+        w, _, _ = fmin_l_bfgs_b(self._loss_function, w0,
+            args=(psi, u, pairs_u, pairs_v), iprint=0)
+        self._w = w
         A, _ = self._get_edge_strength(psi, w)
-        Q0 = self._get_transition_probability(A)
-        P = self._get_stationary_distribution(Q0, u)
+        Q0, _ = self._get_transition_probability(A)
+        P = self._get_stationary_distribution(self._get_stationary_operator(Q0), u)
         return P
@@ -1,13 +1,13 @@
 import os.path
 import json
-from itertools import combinations
+from itertools import combinations, izip
 
 import networkx as nx
 from networkx.readwrite import json_graph
 
 import ghanalyzer.models
 from ghanalyzer.models import Entity, Account, User, Organization, Repository, Language
-from ghanalyzer.utils.jsonline import JsonLineData
+from ghanalyzer.utils.jsonline import JsonLineData, json_loads
 from ghanalyzer.io.items import load_accounts, load_repositories
 
 
@@ -58,11 +58,22 @@ class EntityEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def _intern_entity(entities, cls, id_):
+    """get the cached instance of entity (cls, id_) so that each node is created once"""
+    key = (cls, id_)
+    entity = entities.get(key)
+    if entity is None:
+        entity = entities[key] = cls(id_)
+    return entity
+
 def load_graph(path, graph_type, item_filter=None):
     metadata = GRAPH_METADATA.get(graph_type)
     if not metadata:
         return
     path = os.path.join(path, metadata['filename'])
+    head_name, head_cls = metadata['head']['name'], metadata['head']['class']
+    tail_name, tail_cls = metadata['tail']['name'], metadata['tail']['class']
+    entities = {}
     if metadata['directed']:
         graph = nx.DiGraph()
     else:
@@ -71,24 +82,29 @@ def load_graph(path, graph_type, item_filter=None):
         if item_filter is not None:
             data = (x for x in data if item_filter(x))
         for item in data:
-            head = item.pop(metadata['head']['name'], None)
-            tail = item.pop(metadata['tail']['name'], None)
+            head = item.pop(head_name, None)
+            tail = item.pop(tail_name, None)
             if head is None or tail is None:
                 continue
-            head = metadata['head']['class'](head['id'])
-            tail = metadata['tail']['class'](tail['id'])
-            graph.add_edge(tail, head, **item)
+            head = _intern_entity(entities, head_cls, head['id'])
+            tail = _intern_entity(entities, tail_cls, tail['id'])
+            graph.add_edge(tail, head, attr_dict=item)
     return graph
 
 def load_node_attributes(path, graph):
     repos = load_repositories(path)
     accounts = load_accounts(path)
-    for n in graph:
-        if isinstance(n, Repository):
-            graph.node[n].update(repos[n.id])
-        elif isinstance(n, Account):
-            graph.node[n].update(accounts[n.id])
-        graph.node[n].pop('id', None)
+    datasets = {
+        Repository: repos,
+        Account: accounts,
+        User: accounts,
+        Organization: accounts,
+    }
+    for n, attributes in graph.nodes_iter(data=True):
+        dataset = datasets.get(type(n))
+        if dataset is not None:
+            attributes.update(dataset[n.id])
+        attributes.pop('id', None)
 
 def load_language_co_occurrence(path):
     path = os.path.join(path, 'Languages.jsonl')
@@ -116,23 +132,38 @@ def load_language_graph(path):
                 graph.add_edge(repo, language, weight=v)
     return graph
 
-def _model_from_json(model):
+def _model_from_json(model, entities=None):
     model_type = model['type']
     model_id = model['id']
     if model_type not in ghanalyzer.models.__all__:
         return
     model_class = getattr(ghanalyzer.models, model_type)
-    return model_class(model_id)
+    if entities is None:
+        return model_class(model_id)
+    return _intern_entity(entities, model_class, model_id)
 
-def _node_from_json(node):
-    node['id'] = _model_from_json(node['id'])
-    return node
+def _create_graph(directed, multigraph):
+    if multigraph:
+        return nx.MultiDiGraph() if directed else nx.MultiGraph()
+    return nx.DiGraph() if directed else nx.Graph()
 
 def read_json_graph(path):
+    """read graph in node-link format (as written by write_json_graph)"""
     with open(path) as f:
-        data = json.load(f)
-        data['nodes'] = list(filter(None, (_node_from_json(x) for x in data['nodes'])))
-        return json_graph.node_link_graph(data)
+        data = json_loads(f.read())
+    graph = _create_graph(data.get('directed', False), data.get('multigraph', False))
+    graph.graph = dict(data.get('graph', {}))
+    entities = {}
+    # links refer to nodes by their positions in the node list
+    nodes = [_model_from_json(x.pop('id'), entities) for x in data['nodes']]
+    graph.add_nodes_from((n, x) for n, x in izip(nodes, data['nodes']) if n is not None)
+    links = ((nodes[x.pop('source')], nodes[x.pop('target')], x) for x in data['links'])
+    links = ((u, v, x) for u, v, x in links if u is not None and v is not None)
+    if graph.is_multigraph():
+        graph.add_edges_from((u, v, x.pop('key', None), x) for u, v, x in links)
+    else:
+        graph.add_edges_from(links)
+    return graph
 
 def write_json_graph(path, graph, indent=None):
     data = json_graph.node_link_data(graph)
@@ -1,4 +1,7 @@
-import json
+try:  # use ujson if available (much faster at decoding)
+    from ujson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 class JsonLineData(object):
@@ -15,4 +18,4 @@ class JsonLineData(object):
     def __iter__(self):
         self.data.seek(0)
         for line in self.data:
-            yield json.loads(line)
+            yield json_loads(line)
@@ -1,6 +1,7 @@
 import numpy as np
 from scipy.sparse import coo_matrix, csr_matrix
 cimport numpy as np
+from cython cimport floating
 
 
 def vector_coo_matrix_multiply(np.ndarray[np.float_t, ndim=1] v, M):
@@ -88,3 +89,72 @@ def sum_csr_matrix_column(M):
             result[r] += data[i]
 
     return result
+
+
+def csr_matrix_normalize_row(
+        np.ndarray[int, ndim=1] indptr,
+        np.ndarray[floating, ndim=1] data):
+    """l1-normalize each row of a csr_matrix given its indptr and data,
+    returning the normalized data and the row sums
+    """
+    cdef np.ndarray[floating, ndim=1] result = np.empty((data.shape[0],), dtype=data.dtype)
+    cdef np.ndarray[np.float_t, ndim=1] norm = np.zeros((indptr.shape[0] - 1,))
+    cdef int r, i
+
+    for r in xrange(indptr.shape[0] - 1):
+        if indptr[r] == indptr[r+1]:
+            continue
+        for i in xrange(indptr[r], indptr[r+1]):
+            norm[r] += data[i]
+        for i in xrange(indptr[r], indptr[r+1]):
+            result[i] = data[i] / norm[r]
+
+    return result, norm
+
+
+def csr_matrix_normalize_row_derivative(
+        np.ndarray[int, ndim=1] indptr,
+        np.ndarray[floating, ndim=1] normalized,
+        np.ndarray[np.float_t, ndim=1] norm,
+        np.ndarray[floating, ndim=2] ddata,
+        double scale=1.0):
+    """calculate the derivative of l1-row-normalized csr_matrix data (multiplied by scale)
+    given the normalized data, the row sums and the derivative of data with respect to
+    each parameter (columns of ddata):
+    d(x / sum(x)) = (dx - (x / sum(x)) * sum(dx)) / sum(x)
+    """
+    cdef int n_params = ddata.shape[1]
+    cdef np.ndarray[floating, ndim=2] result = np.empty((ddata.shape[0], n_params),
+        dtype=ddata.dtype, order='F')
+    cdef double dnorm, factor
+    cdef int r, m, i
+
+    for r in xrange(indptr.shape[0] - 1):
+        if indptr[r] == indptr[r+1]:
+            continue
+        factor = scale / norm[r]
+        for m in xrange(n_params):
+            dnorm = 0.0
+            for i in xrange(indptr[r], indptr[r+1]):
+                dnorm += ddata[i, m]
+            for i in xrange(indptr[r], indptr[r+1]):
+                result[i, m] = (ddata[i, m] - normalized[i] * dnorm) * factor
+
+    return result
+
+
+def vector_csr_data_multiply(
+        np.ndarray[np.float_t, ndim=1] v,
+        np.ndarray[int, ndim=1] indptr,
+        np.ndarray[int, ndim=1] indices,
+        np.ndarray[floating, ndim=1] data):
+    """calculate v * M given row vector v and indptr, indices and data of csr_matrix M"""
+    cdef np.ndarray[np.float_t, ndim=1] product = np.zeros((v.shape[0],))
+    cdef int r, c, i
+
+    for r in xrange(indptr.shape[0] - 1):
+        for i in xrange(indptr[r], indptr[r+1]):
+            c = indices[i]
+            product[c] += v[r] * data[i]
+
+    return product